@@ -1,45 +1,108 @@
 from __future__ import print_function
-import json
+import random
 import datetime
 import logging as log
+import threading
 from time import sleep
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 try:
-    from urllib.parse import urlparse, urlencode, urlunparse
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock, so fall back to the wall clock
+    from time import time as monotonic
+
+try:
+    from urllib.parse import quote_plus
 except ImportError:
     # Python 2 imports
-    from urlparse import urlparse, urlunparse
-    from urllib import urlencode
+    from urllib import quote_plus
+
+try:
+    # orjson decodes the response bytes considerably faster than the standard library, so use it when available
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 import requests
+from requests.adapters import HTTPAdapter
 from abc import ABCMeta
 from abc import abstractmethod
-from bs4 import BeautifulSoup
+from lxml import etree, html
 
 __author__ = 'Tom Dickinson'
 
+# Specify a user agent to prevent Twitter from returning a profile card
+_HEADERS = {
+    'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/46.0.2490.'
+                  '86 Safari/537.36'
+}
+
+# Every search URL shares this prefix, with the query and optional max_position appended
+_SEARCH_URL_PREFIX = 'https://twitter.com/i/search/timeline?f=tweets&q='
+
+
+def _has_class(class_name):
+    """
+    Builds an XPath predicate matching elements carrying the given CSS class
+    :param class_name: The class to look for in the element's class attribute
+    :return: A string XPath predicate
+    """
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % class_name
+
+
+def _format_created_at(created_at):
+    """
+    Formats a tweet's created_at time for logging
+    :param created_at: Milliseconds since the epoch, as parsed from a tweet
+    :return: A string in the form YYYY-MM-DD HH:MM:SS
+    """
+    t = datetime.datetime.fromtimestamp(created_at / 1000)
+    # Dropping microseconds and passing sep positionally keeps this working on Python 2, which lacks timespec
+    return t.replace(microsecond=0).isoformat(' ')
+
+
+# Stream items without a tweet id aren't tweets, so they are skipped by the XPath itself
+_STREAM_ITEMS = etree.XPath(".//li[@data-item-id][%s]" % _has_class('js-stream-item'))
+
 
 class TwitterSearch(object):
 
     __meta__ = ABCMeta
 
-    def __init__(self, rate_delay, error_delay=5):
+    def __init__(self, rate_delay, error_delay=5, max_retries=5, timeout=30):
         """
         :param rate_delay: How long to pause between calls to Twitter
-        :param error_delay: How long to pause when an error occurs
+        :param error_delay: How long to pause when an error occurs, doubled on each consecutive failure
+        :param max_retries: How many attempts to make at a call before giving up on it
+        :param timeout: How many seconds to wait on a call to Twitter before treating it as failed
         """
         self.rate_delay = rate_delay
         self.error_delay = error_delay
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        # Shared across threads, so rate_delay spaces out every call to Twitter rather than each thread's own calls
+        self.rate_lock = threading.Lock()
+        self.next_request_time = 0
+
+        # Reuse connections to Twitter across calls rather than opening a new one per request
+        self.session = requests.Session()
+        self.session.headers.update(_HEADERS)
 
     def search(self, query):
-        self.perform_search(query)
+        """
+        :param query: Query to search Twitter with
+        :return: False if we gave up on a call to Twitter before the search completed, True otherwise
+        """
+        return self.perform_search(query)
 
     def perform_search(self, query):
         """
         Scrape items from twitter
         :param query:   Query to search Twitter with. Takes form of queries constructed with using Twitters
                         advanced search: https://twitter.com/search-advanced
+        :return: False if we gave up on a call to Twitter part way through the search, True otherwise
         """
         url = self.construct_url(query)
         continue_search = True
@@ -61,39 +124,51 @@ class TwitterSearch(object):
             # Our max tweet is the last tweet in the list
             max_tweet = tweets[-1]
             if min_tweet['tweet_id'] is not max_tweet['tweet_id']:
-                if "min_position" in response.keys():
+                # Twitter can send a null min_position, so fall back to building the cursor from our tweets
+                if response.get('min_position'):
                     max_position = response['min_position']
                 else:
                     max_position = "TWEET-%s-%s" % (max_tweet['tweet_id'], min_tweet['tweet_id'])
                 url = self.construct_url(query, max_position=max_position)
-                # Sleep for our rate_delay
-                sleep(self.rate_delay)
                 response = self.execute_search(url)
 
+        return response is not None
+
     def execute_search(self, url):
         """
         Executes a search to Twitter for the given URL
         :param url: URL to search twitter with
-        :return: A JSON object with data from Twitter
+        :return: A JSON object with data from Twitter, or None if every attempt failed
         """
-        try:
-            # Specify a user agent to prevent Twitter from returning a profile card
-            headers = {
-                'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/46.0.2490.'
-                              '86 Safari/537.36'
-            }
-            req = requests.get(url, headers=headers)
-            # response = urllib2.urlopen(req)
-            data = json.loads(req.text)
-            return data
-
-        # If we get a ValueError exception due to a request timing out, we sleep for our error delay, then make
-        # another attempt
-        except Exception as e:
-            log.error(e)
-            log.error("Sleeping for %i" % self.error_delay)
-            sleep(self.error_delay)
-            return self.execute_search(url)
+        for attempt in range(self.max_retries):
+            try:
+                self.wait_for_rate_limit()
+                req = self.session.get(url, timeout=self.timeout)
+                req.raise_for_status()
+                return json_loads(req.content)
+
+            # If the request fails or times out, or Twitter returns something that isn't JSON, we back off
+            # exponentially from our error delay, then make another attempt
+            except Exception as e:
+                log.error(e)
+                if attempt + 1 < self.max_retries:
+                    delay = self.error_delay * (2 ** attempt) + random.random()
+                    log.error("Sleeping for %.1f" % delay)
+                    sleep(delay)
+
+        log.error("Giving up on %s after %i attempts" % (url, self.max_retries))
+        return None
+
+    def wait_for_rate_limit(self):
+        """
+        Blocks until at least rate_delay has passed since the last call to Twitter made by any thread
+        """
+        with self.rate_lock:
+            now = monotonic()
+            wait = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.rate_delay
+        if wait > 0:
+            sleep(wait)
 
     @staticmethod
     def parse_tweets(items_html):
@@ -102,16 +177,11 @@ class TwitterSearch(object):
         :param items_html: The HTML block with tweets
         :return: A JSON list of tweets
         """
-        soup = BeautifulSoup(items_html, "html.parser")
+        root = html.fragment_fromstring(items_html, create_parent='div')
         tweets = []
-        for li in soup.find_all("li", class_='js-stream-item'):
-
-            # If our li doesn't have a tweet-id, we skip it as it's not going to be a tweet.
-            if 'data-item-id' not in li.attrs:
-                continue
-
+        for li in _STREAM_ITEMS(root):
             tweet = {
-                'tweet_id': li['data-item-id'],
+                'tweet_id': li.get('data-item-id'),
                 'text': None,
                 'user_id': None,
                 'user_screen_name': None,
@@ -121,32 +191,52 @@ class TwitterSearch(object):
                 'favorites': 0
             }
 
+            # Find the elements holding each field in a single walk over the tweet, keeping the first of each
+            text_p = user_details_div = date_span = retweet_span = favorite_span = None
+            for element in li.iter('p', 'div', 'span'):
+                classes = element.get('class')
+                if classes is None:
+                    continue
+                classes = classes.split()
+                if element.tag == 'p':
+                    if text_p is None and 'tweet-text' in classes:
+                        text_p = element
+                elif element.tag == 'div':
+                    if user_details_div is None and 'tweet' in classes:
+                        user_details_div = element
+                elif '_timestamp' in classes:
+                    if date_span is None:
+                        date_span = element
+                elif 'ProfileTweet-actionCount' in classes:
+                    parent = element.getparent()
+                    parent_classes = (parent.get('class') or '').split() if parent.tag == 'span' else []
+                    if retweet_span is None and 'ProfileTweet-action--retweet' in parent_classes:
+                        retweet_span = element
+                    elif favorite_span is None and 'ProfileTweet-action--favorite' in parent_classes:
+                        favorite_span = element
+
             # Tweet Text
-            text_p = li.find("p", class_="tweet-text")
             if text_p is not None:
-                tweet['text'] = text_p.get_text()
+                tweet['text'] = text_p.text_content()
 
             # Tweet User ID, User Screen Name, User Name
-            user_details_div = li.find("div", class_="tweet")
             if user_details_div is not None:
-                tweet['user_id'] = user_details_div['data-user-id']
-                tweet['user_screen_name'] = user_details_div['data-user-id']
-                tweet['user_name'] = user_details_div['data-name']
+                get = user_details_div.get
+                tweet['user_id'] = get('data-user-id')
+                tweet['user_screen_name'] = get('data-screen-name')
+                tweet['user_name'] = get('data-name')
 
             # Tweet date
-            date_span = li.find("span", class_="_timestamp")
             if date_span is not None:
-                tweet['created_at'] = float(date_span['data-time-ms'])
+                tweet['created_at'] = float(date_span.get('data-time-ms'))
 
             # Tweet Retweets
-            retweet_span = li.select("span.ProfileTweet-action--retweet > span.ProfileTweet-actionCount")
-            if retweet_span is not None and len(retweet_span) > 0:
-                tweet['retweets'] = int(retweet_span[0]['data-tweet-stat-count'])
+            if retweet_span is not None:
+                tweet['retweets'] = int(retweet_span.get('data-tweet-stat-count'))
 
             # Tweet Favourites
-            favorite_span = li.select("span.ProfileTweet-action--favorite > span.ProfileTweet-actionCount")
-            if favorite_span is not None and len(retweet_span) > 0:
-                tweet['favorites'] = int(favorite_span[0]['data-tweet-stat-count'])
+            if favorite_span is not None:
+                tweet['favorites'] = int(favorite_span.get('data-tweet-stat-count'))
 
             tweets.append(tweet)
         return tweets
@@ -159,20 +249,13 @@ class TwitterSearch(object):
         :param max_position: The max_position value to select the next pagination of tweets
         :return: A string URL
         """
+        url = _SEARCH_URL_PREFIX + quote_plus(query)
 
-        params = {
-            # Type Param
-            'f': 'tweets',
-            # Query Param
-            'q': query
-        }
-
-        # If our max_position param is not None, we add it to the parameters
+        # If our max_position param is not None, we add it to the URL
         if max_position is not None:
-            params['max_position'] = max_position
+            url += '&max_position=' + quote_plus(str(max_position))
 
-        url_tupple = ('https', 'twitter.com', '/i/search/timeline', '', urlencode(params), '')
-        return urlunparse(url_tupple)
+        return url
 
     @abstractmethod
     def save_tweets(self, tweets):
@@ -184,13 +267,15 @@ class TwitterSearch(object):
 
 class TwitterSearchImpl(TwitterSearch):
 
-    def __init__(self, rate_delay, error_delay, max_tweets):
+    def __init__(self, rate_delay, error_delay, max_tweets, max_retries=5, timeout=30):
         """
         :param rate_delay: How long to pause between calls to Twitter
-        :param error_delay: How long to pause when an error occurs
+        :param error_delay: How long to pause when an error occurs, doubled on each consecutive failure
         :param max_tweets: Maximum number of tweets to collect for this example
+        :param max_retries: How many attempts to make at a call before giving up on it
+        :param timeout: How many seconds to wait on a call to Twitter before treating it as failed
         """
-        super(TwitterSearchImpl, self).__init__(rate_delay, error_delay)
+        super(TwitterSearchImpl, self).__init__(rate_delay, error_delay, max_retries=max_retries, timeout=timeout)
         self.max_tweets = max_tweets
         self.counter = 0
 
@@ -199,14 +284,13 @@ class TwitterSearchImpl(TwitterSearch):
         Just prints out tweets
         :return:
         """
+        log_tweets = log.getLogger().isEnabledFor(log.INFO)
         for tweet in tweets:
             # Lets add a counter so we only collect a max number of tweets
             self.counter += 1
 
-            if tweet['created_at'] is not None:
-                t = datetime.datetime.fromtimestamp((tweet['created_at']/1000))
-                fmt = "%Y-%m-%d %H:%M:%S"
-                log.info("%i [%s] - %s" % (self.counter, t.strftime(fmt), tweet['text']))
+            if log_tweets and tweet['created_at'] is not None:
+                log.info("%i [%s] - %s" % (self.counter, _format_created_at(tweet['created_at']), tweet['text']))
 
             # When we've reached our max limit, return False so collection stops
             if self.max_tweets is not None and self.counter >= self.max_tweets:
@@ -222,36 +306,63 @@ class TwitterSlicer(TwitterSearch):
     The only additional parameters a user has to input, is a minimum date, and a maximum date.
     This method also supports parallel scraping.
     """
-    def __init__(self, rate_delay, error_delay, since, until, n_threads=1):
-        super(TwitterSlicer, self).__init__(rate_delay, error_delay)
+    def __init__(self, rate_delay, error_delay, since, until, n_threads=1, max_retries=5, timeout=30):
+        super(TwitterSlicer, self).__init__(rate_delay, error_delay, max_retries=max_retries, timeout=timeout)
         self.since = since
         self.until = until
         self.n_threads = n_threads
         self.counter = 0
+        # Day queries this slicer has scraped to completion, so repeated searches don't fetch the same pages again
+        self.searched_days = set()
 
-    def search(self, query):
+        # Keep enough pooled connections around for every thread to hold one open
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=n_threads))
+
+    def search(self, query, rescrape=False):
+        """
+        :param query: Query to search Twitter with, split into one search per day
+        :param rescrape: Search every day again, even those this slicer has already scraped
+        :return: False if any day's search failed or stopped early, True otherwise
+        """
         n_days = (self.until - self.since).days
-        tp = ThreadPoolExecutor(max_workers=self.n_threads)
-        for i in range(0, n_days):
-            since_query = self.since + datetime.timedelta(days=i)
-            until_query = self.since + datetime.timedelta(days=(i + 1))
-            day_query = "%s since:%s until:%s" % (query, since_query.strftime("%Y-%m-%d"),
-                                                  until_query.strftime("%Y-%m-%d"))
-            tp.submit(self.perform_search, day_query)
-        tp.shutdown(wait=True)
+        completed = True
+        with ThreadPoolExecutor(max_workers=self.n_threads) as tp:
+            futures = {}
+            for i in range(0, n_days):
+                since_query = self.since + datetime.timedelta(days=i)
+                until_query = self.since + datetime.timedelta(days=(i + 1))
+                day_query = "%s since:%s until:%s" % (query, since_query.strftime("%Y-%m-%d"),
+                                                      until_query.strftime("%Y-%m-%d"))
+                if not rescrape and day_query in self.searched_days:
+                    continue
+                futures[tp.submit(self.perform_search, day_query)] = day_query
+
+            # Only remember days that completed, so a later search tries the rest again. Log any day that raised,
+            # rather than letting the executor silently drop the exception
+            for future in as_completed(futures):
+                exc = future.exception()
+                if exc is not None:
+                    log.error("Search for %s failed: %s" % (futures[future], exc),
+                              exc_info=(type(exc), exc, getattr(exc, '__traceback__', None)))
+                    completed = False
+                elif future.result():
+                    self.searched_days.add(futures[future])
+                else:
+                    completed = False
+
+        return completed
 
     def save_tweets(self, tweets):
         """
         Just prints out tweets
         :return: True always
         """
+        log_tweets = log.getLogger().isEnabledFor(log.INFO)
         for tweet in tweets:
             # Lets add a counter so we only collect a max number of tweets
             self.counter += 1
-            if tweet['created_at'] is not None:
-                t = datetime.datetime.fromtimestamp((tweet['created_at']/1000))
-                fmt = "%Y-%m-%d %H:%M:%S"
-                log.info("%i [%s] - %s" % (self.counter, t.strftime(fmt), tweet['text']))
+            if log_tweets and tweet['created_at'] is not None:
+                log.info("%i [%s] - %s" % (self.counter, _format_created_at(tweet['created_at']), tweet['text']))
 
         return True
 